@@ -0,0 +1,116 @@
+import importlib.util
+import io
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import pytest
+
+_spec = importlib.util.spec_from_file_location(
+    'tex_thmdep', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tex-thmdep.py'))
+tex_thmdep = importlib.util.module_from_spec(_spec)
+# Registered so that -j workers can unpickle its functions.
+sys.modules[_spec.name] = tex_thmdep
+_spec.loader.exec_module(tex_thmdep)
+
+OPTIONS = {
+    'scan_re': re.compile(tex_thmdep.SCAN_RE),
+    'exclude_re': None,
+    'ignore_envs': frozenset([b'comment']),
+    'follow': False,
+}
+
+# Comments inside \thmdep arguments, as in the common `lem:a,%` line-break idiom.
+ARG_COMMENTS_TEX = b'''\\begin{theorem}\\label{thm:c}
+\\thmdep{lem:a,%
+lem:b}{thm:c}
+\\thmdep{lem:d}{% main theorem
+thm:e}
+\\thmdep{lem:f,% see {x} and }
+lem:g}{thm:c}
+\\label{lem:h% label comment
+}\\thmdep{lem:i}{}
+\\thmdep{lem:j\\%k}{thm:c} % \\thmdep{q}{r}
+\\end{theorem}
+'''
+
+
+def extract_edges(s):
+    edges = {}
+    tex_thmdep.extract_from_file(io.BytesIO(s), edges, 'test.tex', OPTIONS)
+    return list(edges)
+
+
+def test_comments_in_arguments_are_stripped():
+    assert extract_edges(ARG_COMMENTS_TEX) == [
+        ('thm:c', 'lem:a'),
+        ('thm:c', '\nlem:b'),
+        ('\nthm:e', 'lem:d'),
+        ('thm:c', 'lem:f'),
+        ('thm:c', '\nlem:g'),
+        ('lem:h\n', 'lem:i'),
+        ('thm:c', 'lem:j\\%k'),
+    ]
+
+
+def test_no_split_inside_argument_with_commented_brace():
+    assert tex_thmdep._split_point(b'\\thmdep{a,% }\nb') == 0
+    assert tex_thmdep._split_point(b'\\label{a}\n\\thmdep{a,% }\nb') == len(b'\\label{a}\n')
+
+
+def test_split_inside_commented_block():
+    s = b'\\label{a}\n% \\thmdep{b}{c} old\n% {\n'
+    assert tex_thmdep._split_point(s) == len(s)
+
+
+def test_commented_block_longer_than_chunk():
+    line = b'% \\thmdep{lem:1}{thm:1} old stuff\n'
+    block = line * (2 * tex_thmdep.CHUNK_SIZE // len(line))
+    s = b'\\thmdep{lem:a}{thm:a}\n' + block + b'\\thmdep{lem:b}{thm:b}\n'
+    chunks = list(tex_thmdep._iter_chunks(io.BytesIO(s)))
+    assert len(chunks) > 1 and b''.join(chunks) == s
+    assert extract_edges(s) == [('thm:a', 'lem:a'), ('thm:b', 'lem:b')]
+
+
+def test_split_point_is_linear():
+    # Every newline here is after an unclosed {, so the walk goes back to the start.
+    # Rescanning for } on each step took over 3 s on 1 MiB.
+    s = b'{\n' * (tex_thmdep.CHUNK_SIZE // 2)
+    start = time.time()
+    assert tex_thmdep._split_point(s) == 0
+    assert time.time() - start < 0.5
+
+
+def test_unsplittable_tail_is_read_at_once():
+    s = b'\\thmdep{lem:a,\n' + b'lem:b,\n' * 100 + b'lem:c}{thm:a}\n'
+    chunks = list(tex_thmdep._iter_chunks(io.BytesIO(s), size=16))
+    assert chunks == [s]
+
+
+FOLLOW_FILES = {
+    'main.tex': b'\\thmdep{a}{m}\\input{b.tex}\\input{missing.tex}\\input{c.tex}\\thmdep{x}{m}\n',
+    'b.tex': b'\\thmdep{d}{b}\\input{e.tex}\n',
+    'c.tex': b'\\thmdep{a}{m}\\thmdep{f}{c}\\input{b.tex}\\input{e.tex}\n',
+    'e.tex': b'\\thmdep{g,a}{e}\n',
+}
+
+
+def test_jobs_keep_follow_order(tmp_path, monkeypatch):
+    if multiprocessing.get_start_method() != 'fork':
+        pytest.skip('workers can only unpickle tex_thmdep when forked')
+    for name, s in FOLLOW_FILES.items():
+        (tmp_path / name).write_bytes(s)
+    monkeypatch.chdir(tmp_path)
+    options = dict(OPTIONS, follow=True, verbose=0, max_dist=None, show_label=False,
+        show_dist=True)
+    outputs = []
+    for jobs in (1, 2):
+        edges = tex_thmdep.extract_from_files(['main.tex'], dict(options, jobs=jobs))
+        ofp = io.StringIO()
+        tex_thmdep.output(tex_thmdep.process(edges, options), 'tikz', options, [], ofp)
+        outputs.append((list(edges), ofp.getvalue()))
+    assert outputs[0][0] == [('m', 'a'), ('m', 'x'), ('b', 'd'), ('c', 'f'), ('e', 'g'),
+        ('e', 'a')]
+    assert outputs[1] == outputs[0]
@@ -9,11 +9,38 @@ from __future__ import print_function
 import sys
 import argparse
 import re
-from collections import defaultdict, deque
-
-
-COMMENT_RE = r'(?<!\\)%[^\n]*\n'
-ENTITY_RE = r'\\(thmdep|thmdepcref){([^}]*)}{([^}]*)}|\\(label|begin|end|input){([^}]*)}'
+from array import array
+from collections import OrderedDict, deque
+
+
+# Patterns are bytes: files are scanned undecoded and only captured groups are decoded.
+# An escaped \\% is matched (and skipped) like a comment, so that the % after it does
+# not start one. This avoids a lookbehind, which re2 does not support.
+COMMENT_RE = br'\\%|%[^\n]*\n'
+# An argument runs up to the first } that is not in a comment: a comment inside it
+# (e.g. after a comma, before a line break) is kept whole, even if it has a }, and
+# is stripped from the captured text afterwards with ARG_COMMENT_PAT.
+# Written as normal* (special normal*)* so that there is only one way to match, which
+# keeps failed matches from backtracking.
+ARG_RE = br'([^}%\\]*(?:(?:\\+[^}\\]|%[^\n]*\n)[^}%\\]*)*\\*)'
+ENTITY_RE = (br'\\(thmdep|thmdepcref){' + ARG_RE + b'}{' + ARG_RE + b'}'
+    + br'|\\(label|begin|end|input){' + ARG_RE + b'}')
+# Comments are matched (and skipped) in the same scan as entities.
+# COMMENT_RE has no groups, so ENTITY_RE's five groups are the only ones.
+SCAN_RE = COMMENT_RE + b'|' + ENTITY_RE
+# Captured arguments are short, so the lookbehind (unsupported by re2) is fine here.
+ARG_COMMENT_PAT = re.compile(br'(?<!\\)%[^\n]*\n')
+# Comments without their newline, so that stripping them keeps lines in place.
+# Starting with a literal % (lookbehind second) lets re skip quickly to each %.
+_LINE_COMMENT_PAT = re.compile(br'%(?<!\\%)[^\n]*')
+# The last newline whose last preceding brace is a }, or which has no brace before it.
+# Greedy backtracking tries each } from the end once, so this is linear.
+_SPLIT_NEWLINE_PAT = re.compile(br'[\s\S]*\}[^{}]*\n|[^{}]*\n')
+# b'%'[0] is an int on Python 3, and `int in bytes` is much faster than `b'%' in bytes`
+_PERCENT = b'%'[0]
+CHUNK_SIZE = 1 << 20
+MAX_TAIL_CHUNKS = 4  # held-back text, in chunks, after which the rest is read at once
+UNSET = -1  # dist of nodes not reachable from any root
 DEFAULT_IGNORE_ENVS = ('comment', 'error')
 DEFAULT_RAW_OPTIONS = {
     'tikz': [
@@ -30,6 +57,26 @@ try:
 except NameError:
     FileNotFoundError = IOError
 
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# Plain dicts keep insertion order only from Python 3.7 on.
+edge_dict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+try:
+    intern = sys.intern
+except AttributeError:
+    pass  # Python 2 has intern as a builtin
+
+if bytes is str:
+    def _text(b):  # Python 2: labels stay native (byte) strings, as when reading text
+        return b
+else:
+    def _text(b):
+        return b.decode('utf-8', 'replace')
+
 
 def warn(*args):
     print('tex-thmdep: WARNING:', *args, file=sys.stderr)
@@ -39,143 +86,331 @@ def debug(*args):
     print('tex-thmdep:', *args, file=sys.stderr)
 
 
-def extract(s, edges, ifpath, options):
-    curr_node = ''
-    ignore_mode = False
-    files = set()
-    empty_thm_warned = False
+class ScanState(object):
+    """Per-file state of extract() which is carried across chunks."""
+    __slots__ = ('curr_node', 'ignore_mode', 'empty_thm_warned')
+
+    def __init__(self):
+        self.curr_node = ''
+        self.ignore_mode = False
+        self.empty_thm_warned = False
+
+
+def extract(s, edges, ifpath, options, state):
+    curr_node = state.curr_node
+    ignore_mode = state.ignore_mode
+    empty_thm_warned = state.empty_thm_warned
+    # \input targets, as keys of an ordered dict so that they are followed in order
+    files = edge_dict()
     count = 0
-    s = re.sub(COMMENT_RE, '\n', s, flags=re.MULTILINE)
-    for match in re.finditer(ENTITY_RE, s, flags=re.MULTILINE):
-        if match.group(4) is not None:
-            cmd, arg = match.group(4), match.group(5)
+    exclude_match = options['exclude_re'].match if options['exclude_re'] is not None else None
+    ignore_envs = options['ignore_envs']
+    follow = options['follow']
+    percent = _PERCENT
+    # findall gives '' for groups of the alternatives that did not match,
+    # so comments come out with every group empty and are skipped.
+    for (thmdep_cmd, lems, thm, cmd, arg) in options['scan_re'].findall(s):
+        if cmd:
+            if percent in arg:
+                arg = ARG_COMMENT_PAT.sub(b'\n', arg)
             if ignore_mode:
-                if cmd == 'end' and arg in options['ignore_envs']:
+                if cmd == b'end' and arg in ignore_envs:
                     ignore_mode = False
             else:
-                if cmd == 'begin' and arg in options['ignore_envs']:
+                if cmd == b'begin' and arg in ignore_envs:
                     ignore_mode = True
-                elif cmd == 'label':
-                    curr_node = arg
-                elif cmd == 'input' and arg.endswith('.tex') and options['follow']:
-                    files.add(arg)
-        elif not ignore_mode:
-            lems, thm = match.group(2), match.group(3)
-            if thm == '':
+                elif cmd == b'label':
+                    curr_node = intern(_text(arg))
+                elif cmd == b'input' and follow and arg.endswith(b'.tex'):
+                    files[_text(arg)] = None
+        elif thmdep_cmd and not ignore_mode:
+            if percent in lems:
+                lems = ARG_COMMENT_PAT.sub(b'\n', lems)
+            if percent in thm:
+                thm = ARG_COMMENT_PAT.sub(b'\n', thm)
+            if thm == b'':
                 thm = curr_node
                 if curr_node == '' and not empty_thm_warned:
                     warn(r'use of empty thm before \label in ' + ifpath)
                     empty_thm_warned = True
-            for lem in lems.split(','):
-                if (not lem.startswith(options['exclude_prefixes'])
-                        and not thm.startswith(options['exclude_prefixes'])):  # noqa
-                    edges.append((thm, lem))
+            else:
+                thm = intern(_text(thm))
+            if exclude_match is not None and exclude_match(thm) is not None:
+                continue
+            for lem in lems.split(b','):
+                lem = _text(lem)
+                if exclude_match is None or exclude_match(lem) is None:
+                    edges[thm, intern(lem)] = None
                     count += 1
+    state.curr_node = curr_node
+    state.ignore_mode = ignore_mode
+    state.empty_thm_warned = empty_thm_warned
+    return (count, files)
+
+
+def _split_point(s):
+    """Return an index just after a newline in s such that no entity or comment
+    spans it, or 0 if there is no such index.
+
+    Entity arguments may contain newlines, so a newline is a safe place to split
+    only if the last { or } before it is not a {. Braces in comments are skipped:
+    one in a comment does not close an argument, and none in a comment opens one."""
+    code = _LINE_COMMENT_PAT.sub(b'', s)
+    j = code.rfind(b'\n')
+    if j < 0:
+        return 0
+    close_pos = code.rfind(b'}', 0, j)
+    if code.find(b'{', close_pos + 1, j) >= 0:
+        # The last newline is inside an argument, so find the last one that is not.
+        m = _SPLIT_NEWLINE_PAT.match(code)
+        if m is None:
+            return 0
+        j = m.end() - 1
+    # code has the same lines as s, so the newline at j is the one in s which has
+    # as many newlines after it.
+    return len(s.rsplit(b'\n', code.count(b'\n', j))[0]) + 1
+
+
+def _iter_chunks(ifp, size=CHUNK_SIZE):
+    tail = b''
+    while True:
+        buf = ifp.read(size)
+        if not buf:
+            break
+        buf = tail + buf
+        i = _split_point(buf)
+        if i:
+            yield buf[:i]
+        tail = buf[i:]
+        if len(tail) > MAX_TAIL_CHUNKS * size:
+            # No split point for a long stretch: scan the rest of the file at once
+            # rather than copying and rescanning the held-back text for every read.
+            tail += ifp.read()
+            break
+    if tail:
+        yield tail
+
+
+def extract_from_file(ifp, edges, ifpath, options):
+    state = ScanState()
+    count = 0
+    files = edge_dict()
+    for chunk in _iter_chunks(ifp):
+        chunk_count, chunk_files = extract(chunk, edges, ifpath, options, state)
+        count += chunk_count
+        files.update(chunk_files)
     return (count, files)
 
 
+def extract_from_path(ifpath, edges, options):
+    """Return (count, files) like extract(), or None if ifpath does not exist."""
+    try:
+        ifp = open(ifpath, 'rb', buffering=CHUNK_SIZE)
+    except FileNotFoundError:
+        return None
+    with ifp:
+        return extract_from_file(ifp, edges, ifpath, options)
+
+
+def _extract_worker(args):
+    ifpath, options = args
+    edges = edge_dict()
+    result = extract_from_path(ifpath, edges, options)
+    if result is None:
+        return None
+    count, files = result
+    return (list(edges), count, files)
+
+
+def _merge_results(results, edges):
+    for result in results:
+        if result is None:
+            yield None
+        else:
+            file_edges, count, files = result
+            # update() keeps the position of edges that are already present
+            edges.update(edge_dict.fromkeys(file_edges))
+            yield (count, files)
+
+
 def extract_from_files(ifpaths, options):
-    edges = []
+    # ordered dict rather than set: drops duplicate edges but keeps output order stable.
+    # Keys stay (thm, lem) tuples: packing label ids into one int key still needs a
+    # hash of each label to find its id, and measured slower than hashing the tuple.
+    edges = edge_dict()
     edge_count = {}
-    files_queue = deque(ifpaths)
     visited_files = set()
-    while files_queue:
-        ifpath = files_queue.popleft()
-        if ifpath not in visited_files:
-            visited_files.add(ifpath)
-            try:
-                with open(ifpath) as ifp:
-                    s = ifp.read()
-            except FileNotFoundError:
-                warn('input file not found:', ifpath)
-                continue
-            count, new_files = extract(s, edges, ifpath, options)
-            if count:
-                edge_count[ifpath] = count
-            for fpath2 in new_files:
-                if fpath2 not in visited_files:
-                    files_queue.append(fpath2)
+    if options['jobs'] > 1:
+        from multiprocessing import Pool
+        pool = Pool(options['jobs'])
+    else:
+        pool = None
+    batch = ifpaths
+    try:
+        # Files are read one \input level at a time, which visits them in the same
+        # order as a FIFO queue would. Results are merged in that order, so the
+        # output does not depend on the number of jobs.
+        while batch:
+            paths = []
+            for ifpath in batch:
+                if ifpath not in visited_files:
+                    visited_files.add(ifpath)
+                    paths.append(ifpath)
+            if pool is None:
+                results = (extract_from_path(ifpath, edges, options) for ifpath in paths)
+            else:
+                results = _merge_results(
+                    pool.imap(_extract_worker, [(ifpath, options) for ifpath in paths]), edges)
+            batch = []
+            for ifpath, result in zip(paths, results):
+                if result is None:
+                    warn('input file not found:', ifpath)
+                    continue
+                count, new_files = result
+                if count:
+                    edge_count[ifpath] = count
+                batch.extend(fpath2 for fpath2 in new_files if fpath2 not in visited_files)
+    except BaseException:
+        # Do not wait for the queued files when a worker fails or on Ctrl-C.
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
     if options['verbose']:
         debug('edge-count:', edge_count)
     return edges
 
 
-class VertexInfo(object):
-    __slots__ = ('adj', 'radj', 'dist', 'visited')
+class Graph(object):
+    """Graph in compressed sparse row (CSR) form.
 
-    def __init__(self):
-        self.adj = []
-        self.radj = []
+    Nodes are ids in range(len(labels)). The out-neighbours of node u are
+    col_idx[row_ptr[u]:row_ptr[u + 1]]."""
+    __slots__ = ('labels', 'row_ptr', 'col_idx', 'dist')
+
+    def __init__(self, labels, row_ptr, col_idx):
+        self.labels = labels
+        self.row_ptr = row_ptr
+        self.col_idx = col_idx
         self.dist = None
-        self.visited = False
 
 
-def bfs(nodes):
-    q = deque()
-    for u, uinf in nodes.items():
-        if not uinf.radj:
-            q.append(u)
-            uinf.dist = 0
+def _csr(n, us, vs):
+    """Return (row_ptr, col_idx) for the graph on range(n) whose edges are zip(us, vs)."""
+    row_ptr = array('i', [0]) * (n + 1)
+    for u in us:
+        row_ptr[u + 1] += 1
+    for u in range(n):
+        row_ptr[u + 1] += row_ptr[u]
+    col_idx = array('i', [0]) * row_ptr[n]
+    pos = row_ptr[:n]
+    for u, v in zip(us, vs):
+        col_idx[pos[u]] = v
+        pos[u] += 1
+    return (row_ptr, col_idx)
+
+
+def bfs(graph):
+    n = len(graph.labels)
+    row_ptr, col_idx = graph.row_ptr, graph.col_idx
+    has_parent = bytearray(n)
+    for v in col_idx:
+        has_parent[v] = 1
+    roots = [u for u in range(n) if not has_parent[u]]
+    # Multi-source BFS: nodes leave the queue in non-decreasing order of dist,
+    # so the first dist assigned to a node is already its minimum.
+    dist = array('i', [UNSET]) * n
+    q = deque(roots)
+    popleft, push = q.popleft, q.append
+    for u in roots:
+        dist[u] = 0
     while q:
-        u = q.popleft()
-        uinf = nodes[u]
-        if not uinf.visited:
-            uinf.visited = True
-            for v in uinf.adj:
-                vinf = nodes[v]
-                if not vinf.visited:
-                    if vinf.dist is None or vinf.dist > uinf.dist + 1:
-                        vinf.dist = uinf.dist + 1
-                    q.append(v)
+        u = popleft()
+        du = dist[u] + 1
+        for j in range(row_ptr[u], row_ptr[u + 1]):
+            v = col_idx[j]
+            if dist[v] == UNSET:
+                dist[v] = du
+                push(v)
+    graph.dist = dist
 
 
 def process(edges, options):
-    nodes = defaultdict(VertexInfo)
-    seen_edges = set()
-    for (u, v) in edges:
-        if (u, v) not in seen_edges:
-            seen_edges.add((u, v))
-            nodes[u].adj.append(v)
-            nodes[v].radj.append(u)
-    bfs(nodes)
-
-    bad_nodes = set()
+    # One dict probe per endpoint: ids are assigned and looked up in the same pass.
+    label_to_id = {}
+    labels = []
+    us = array('i', [0]) * len(edges)
+    vs = array('i', [0]) * len(edges)
+    get_id, add_label = label_to_id.get, labels.append
+    for i, (u, v) in enumerate(edges):
+        uid = get_id(u)
+        if uid is None:
+            uid = label_to_id[u] = len(labels)
+            add_label(u)
+        vid = get_id(v)
+        if vid is None:
+            vid = label_to_id[v] = len(labels)
+            add_label(v)
+        us[i] = uid
+        vs[i] = vid
+    graph = Graph(labels, *_csr(len(labels), us, vs))
+    bfs(graph)
+
     if options['max_dist'] is not None:
         max_dist = options['max_dist']
-        for v, vinf in nodes.items():
-            if vinf.dist > max_dist:
-                bad_nodes.add(v)
-    for v in bad_nodes:
-        del nodes[v]
-    for u, uinf in nodes.items():
-        uinf.adj = [v for v in uinf.adj if v in nodes]
-        uinf.radj = [v for v in uinf.radj if v in nodes]
-
-    return nodes
-
-
-def output(nodes, format, options, raw_options, ofp):
+        dist = graph.dist
+        new_id = array('i', [UNSET]) * len(labels)
+        good_labels = []
+        good_dist = array('i')
+        for u, label in enumerate(labels):
+            if not dist[u] > max_dist:
+                new_id[u] = len(good_labels)
+                good_labels.append(label)
+                good_dist.append(dist[u])
+        # Compact the CSR arrays in place of rebuilding them: kept rows stay in
+        # order, so row_ptr can be filled in as the kept targets are copied.
+        row_ptr, col_idx = graph.row_ptr, graph.col_idx
+        good_row_ptr = array('i', [0])
+        good_col_idx = array('i')
+        for u in range(len(labels)):
+            if new_id[u] != UNSET:
+                for j in range(row_ptr[u], row_ptr[u + 1]):
+                    v = new_id[col_idx[j]]
+                    if v != UNSET:
+                        good_col_idx.append(v)
+                good_row_ptr.append(len(good_col_idx))
+        graph = Graph(good_labels, good_row_ptr, good_col_idx)
+        graph.dist = good_dist
+
+    return graph
+
+
+def output(graph, format, options, raw_options, ofp):
     if format == 'tikz':
-        header = '\\begin{tikzpicture}\n\\graph[#1] {'.replace('#1', ', '.join(raw_options))
-        print(header, file=ofp)
-        for v, vinf in nodes.items():
-            sub_parts = []
-            if options['show_label']:
-                sub_parts.append((r'\texttt', v))
-            if options['show_dist']:
-                sub_parts.append(('', 'dist: ' + str(vinf.dist)))
-            if sub_parts:
-                tinytt_text = r'\\' + r'\\'.join([
-                    r'{\tiny#1{#2}}'.replace('#1', x).replace('#2', y)
-                    for x, y in sub_parts])
-            else:
-                tinytt_text = ''
-            print(r'"#1"/"\cref{#1}'.replace('#1', v) + tinytt_text + '";', file=ofp)
-        for u, uinf in nodes.items():
-            for v in uinf.adj:
-                line = '"#1" -> "#2";'.replace('#1', u).replace('#2', v)
-                print(line, file=ofp)
-        print('};\n\\end{tikzpicture}', file=ofp)
+        parts = []
+        append = parts.append
+        append('\\begin{tikzpicture}\n\\graph[%s] {\n' % ', '.join(raw_options))
+        labels, dist = graph.labels, graph.dist
+        node_tpl = '"%(v)s"/"\\cref{%(v)s}'
+        if options['show_label']:
+            node_tpl += r'\\{\tiny\texttt{%(v)s}}'
+        if options['show_dist']:
+            node_tpl += r'\\{\tiny{dist: %(d)s}}'
+        node_tpl += '";\n'
+        for u, v in enumerate(labels):
+            d = dist[u]
+            append(node_tpl % {'v': v, 'd': d if d != UNSET else None})
+        # Walk col_idx once in CSR row order; row_ptr only gives each row's source.
+        row_ptr, col_idx = graph.row_ptr, graph.col_idx
+        sources = []
+        for u, ulabel in enumerate(labels):
+            sources.extend([ulabel] * (row_ptr[u + 1] - row_ptr[u]))
+        parts.extend(['"%s" -> "%s";\n' % (ulabel, labels[v])
+            for ulabel, v in zip(sources, col_idx)])
+        append('};\n\\end{tikzpicture}\n')
+        ofp.write(''.join(parts))
     else:
         raise NotImplementedError("format {} is not supported".format(repr(format)))
 
@@ -200,24 +435,38 @@ def main():
         help='maximum distance allowed for a node to be displayed')
     parser.add_argument('--follow', action='store_true', default=False,
         help='go to files pointed by \\input')
+    parser.add_argument('--regex-engine', choices=('re', 're2'), default='re',
+        help='regex engine used to scan input files (re2 needs the google-re2 package)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of processes used to read input files')
     parser.add_argument('-v', '--verbose', action='count', default=0)
     args = parser.parse_args()
 
-    non_option_names = ['ifpaths', 'output', 'format', 'raw_options']
+    non_option_names = ['ifpaths', 'output', 'format', 'raw_options', 'regex_engine',
+        'exclude_prefixes']
     args.exclude_prefixes = tuple(args.exclude_prefixes or ())
-    args.ignore_envs = tuple(args.ignore_envs or DEFAULT_IGNORE_ENVS)
+    args.ignore_envs = frozenset(env if isinstance(env, bytes) else env.encode('utf-8')
+        for env in args.ignore_envs or DEFAULT_IGNORE_ENVS)
     arg_vars = vars(args)
     options = {k: v for k, v in arg_vars.items() if k not in non_option_names}
+    if args.regex_engine == 're2':
+        if re2 is None:
+            parser.error('--regex-engine=re2 requires the google-re2 package')
+        options['scan_re'] = re2.compile(SCAN_RE)
+    else:
+        options['scan_re'] = re.compile(SCAN_RE)
+    options['exclude_re'] = (re.compile('|'.join(re.escape(p) for p in args.exclude_prefixes))
+        if args.exclude_prefixes else None)
     raw_options = args.raw_options or DEFAULT_RAW_OPTIONS[args.format]
 
     edges = extract_from_files(args.ifpaths, options)
-    nodes = process(edges, options)
+    graph = process(edges, options)
 
     if args.output is None:
-        output(nodes, args.format, options, raw_options, sys.stdout)
+        output(graph, args.format, options, raw_options, sys.stdout)
     else:
         with open(args.output, 'w') as ofp:
-            output(nodes, args.format, options, raw_options, ofp)
+            output(graph, args.format, options, raw_options, ofp)
 
 
 if __name__ == '__main__':